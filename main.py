@@ -1,8 +1,14 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from dataclasses import dataclass
+from bisect import bisect_right
+from functools import lru_cache
+import logging
+import math
 import os
+import re
 from dotenv import load_dotenv
 import openai
 import json
@@ -10,6 +16,11 @@ import json
 # Load environment variables
 load_dotenv()
 
+# Configure logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL if isinstance(logging.getLevelName(LOG_LEVEL), int) else "INFO")
+logger = logging.getLogger("quotation")
+
 app = FastAPI(
     title="Alrouf Quotation Microservice",
     description="Generate quotations with pricing calculations and email drafts",
@@ -49,6 +60,7 @@ class MockOpenAI:
                 # Find language preference - look for the language in the prompt
                 lang_match = re.search(r'Generate a professional quotation email in (\w+) language', last_message, re.IGNORECASE)
                 language = lang_match.group(1).lower() if lang_match else "en"
+                is_ar = language in ("ar", "arabic")
                 
                 # Find currency
                 currency_match = re.search(r'Currency: (\w+)', last_message)
@@ -80,6 +92,20 @@ class MockOpenAI:
                 total_match = re.search(rf'Total: {currency} ([\d.]+)', last_message)
                 total_amount = total_match.group(1) if total_match else "0.00"
                 
+                # Find totals breakdown (subtotal, discount, freight, VAT)
+                breakdown_labels = [
+                    ("Subtotal", "Subtotal", "المجموع الفرعي"),
+                    ("Discount", "Discount", "الخصم"),
+                    ("Freight", "Freight", "رسوم الشحن"),
+                    ("VAT", "VAT", "ضريبة القيمة المضافة"),
+                ]
+                breakdown = []
+                for key, en_label, ar_label in breakdown_labels:
+                    line_match = re.search(rf'{key}( \([\d.]+%\))?: {currency} ([\d.]+)', last_message)
+                    if line_match:
+                        label = ar_label if is_ar else en_label
+                        breakdown.append(f"- {label}{line_match.group(1) or ''}: {currency} {line_match.group(2)}")
+                
                 # Find delivery terms
                 delivery_match = re.search(r'Delivery Terms: (.+?)(?:\n|$)', last_message)
                 delivery_terms = delivery_match.group(1) if delivery_match else "Standard delivery"
@@ -89,7 +115,7 @@ class MockOpenAI:
                 notes = notes_match.group(1) if notes_match else "None"
                 
                 # Generate dynamic email based on language
-                if language == "ar":
+                if is_ar:
                     # Arabic email template
                     email_content = f"""الموضوع: عرض سعر - أعمدة الإنارة
 
@@ -100,6 +126,8 @@ class MockOpenAI:
 **ملخص العرض:**
 {chr(10).join(items) if items else "- لم يتم تحديد منتجات"}
 
+{chr(10).join(breakdown)}
+
 **المبلغ الإجمالي: {currency} {total_amount}**
 
 **شروط التسليم:** {delivery_terms}
@@ -124,6 +152,8 @@ Thank you for your inquiry regarding our lighting products. Please find our quot
 **Quotation Summary:**
 {chr(10).join(items) if items else "- No items specified"}
 
+{chr(10).join(breakdown)}
+
 **Total Amount: {currency} {total_amount}**
 
 **Delivery Terms:** {delivery_terms}
@@ -166,7 +196,7 @@ class QuotationItem(BaseModel):
 
 class QuotationRequest(BaseModel):
     client: ClientInfo
-    currency: str = Field(..., description="Currency code (e.g., SAR, USD)")
+    currency: str = Field(..., pattern=r"^[A-Za-z]{3}$", description="ISO 4217 currency code (e.g., SAR, USD)")
     items: List[QuotationItem]
     delivery_terms: str = Field(..., description="Delivery terms")
     notes: Optional[str] = Field(None, description="Additional notes")
@@ -179,6 +209,20 @@ class QuotationLine(BaseModel):
     unit_price: float
     line_total: float
 
+class TotalsBreakdown(BaseModel):
+    incoterm: Optional[str]
+    jurisdiction: str
+    jurisdiction_note: Optional[str] = None
+    discount_pct: float
+    discount: float
+    discount_note: Optional[str] = None
+    freight_pct: float
+    freight: float
+    taxable_amount: float
+    vat_pct: float
+    vat: float
+    grand_total: float
+
 class QuotationResponse(BaseModel):
     quotation_id: str
     client: ClientInfo
@@ -187,9 +231,258 @@ class QuotationResponse(BaseModel):
     delivery_terms: str
     notes: Optional[str]
     subtotal: float
+    totals: TotalsBreakdown
     grand_total: float
     email_draft: str
 
+# Tax, VAT and fees tables (loaded once at import and indexed for lookup)
+DEFAULT_JURISDICTION = "SA"
+
+JURISDICTIONS = {
+    # code: (VAT %, delivery locations in English and Arabic)
+    "SA": (15.0, ["Riyadh", "Jeddah", "Dammam", "Khobar", "Dhahran", "Jubail", "Makkah", "Madinah",
+                  "الرياض", "جدة", "الدمام", "الخبر", "الظهران", "الجبيل", "مكة", "المدينة المنورة"]),
+    "AE": (5.0, ["Dubai", "Abu Dhabi", "Sharjah", "دبي", "أبوظبي", "الشارقة"]),
+    "BH": (10.0, ["Manama", "المنامة"]),
+    "OM": (5.0, ["Muscat", "مسقط"]),
+    "KW": (0.0, ["Kuwait", "الكويت"]),
+    "QA": (0.0, ["Doha", "الدوحة"]),
+}
+
+# Freight adder as a percentage of the discounted subtotal, by Incoterm
+INCOTERM_FREIGHT_PCT = {
+    "EXW": 0.0,
+    "FCA": 0.0,
+    "FOB": 0.0,
+    "CPT": 2.0,
+    "CFR": 2.0,
+    "CIF": 2.5,
+    "DAP": 3.0,
+    "DPU": 3.0,
+    "DDP": 3.5,
+}
+
+# Volume discount tiers: (minimum subtotal in SAR, discount %), ascending
+DISCOUNT_TIERS = [(0.0, 0.0), (100000.0, 2.0), (250000.0, 3.0), (500000.0, 5.0)]
+
+# SAR per unit of each supported quote currency (fixed pegs to USD at 3.75 SAR)
+SAR_EXCHANGE_RATES = {
+    "SAR": 1.0,
+    "USD": 3.75,
+    "AED": 1.0211,
+    "BHD": 9.9734,
+    "OMR": 9.7529,
+    "QAR": 1.0302,
+}
+
+VAT_RATES = {code: vat_pct for code, (vat_pct, _) in JURISDICTIONS.items()}
+LOCATION_INDEX = {
+    location.lower(): code
+    for code, (_, locations) in JURISDICTIONS.items()
+    for location in locations
+}
+# Arabic place names may carry an attached preposition or conjunction (e.g. "بالرياض")
+LOCATION_PATTERN = re.compile(
+    r"(?:\b|(?<=\b[بلوف]))(" + "|".join(re.escape(location) for location in sorted(LOCATION_INDEX, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE,
+)
+INCOTERM_PATTERN = re.compile(r"\b(" + "|".join(INCOTERM_FREIGHT_PCT) + r")\b", re.IGNORECASE)
+DISCOUNT_THRESHOLDS = [threshold for threshold, _ in DISCOUNT_TIERS]
+
+@lru_cache(maxsize=256)
+def parse_delivery_terms(delivery_terms: str) -> Tuple[Optional[str], Optional[str]]:
+    """Return (incoterm, jurisdiction) parsed from free-text terms like "DAP Dammam, 4 weeks".
+
+    Either element is None when the terms name no known Incoterm or location.
+    """
+    incoterm_match = INCOTERM_PATTERN.search(delivery_terms)
+    incoterm = incoterm_match.group(1).upper() if incoterm_match else None
+    # Prefer the named place following the Incoterm, then any location in the text
+    location_match = (
+        (incoterm_match and LOCATION_PATTERN.search(delivery_terms, incoterm_match.end()))
+        or LOCATION_PATTERN.search(delivery_terms)
+    )
+    jurisdiction = LOCATION_INDEX[location_match.group(1).lower()] if location_match else None
+    return incoterm, jurisdiction
+
+def calculate_totals(subtotal: float, delivery_terms: str, currency: str = "SAR") -> TotalsBreakdown:
+    """Apply volume discount, freight adder and VAT to a priced subtotal."""
+    incoterm, jurisdiction = parse_delivery_terms(delivery_terms)
+    if jurisdiction is None:
+        jurisdiction = DEFAULT_JURISDICTION
+        jurisdiction_note = f"Delivery location not recognised: defaulted to {DEFAULT_JURISDICTION} VAT"
+    else:
+        jurisdiction_note = None
+    sar_rate = SAR_EXCHANGE_RATES.get(currency.upper())
+    if sar_rate is None:
+        discount_pct = 0.0
+        discount_note = f"Volume discount not applied: unsupported currency {currency}"
+    else:
+        discount_pct = DISCOUNT_TIERS[bisect_right(DISCOUNT_THRESHOLDS, subtotal * sar_rate) - 1][1]
+        discount_note = None
+    freight_pct = INCOTERM_FREIGHT_PCT.get(incoterm, 0.0)
+    vat_pct = VAT_RATES[jurisdiction]
+    
+    discount = round(subtotal * discount_pct / 100, 2)
+    freight = round((subtotal - discount) * freight_pct / 100, 2)
+    taxable_amount = round(subtotal - discount + freight, 2)
+    vat = round(taxable_amount * vat_pct / 100, 2)
+    grand_total = round(taxable_amount + vat, 2)
+    
+    return TotalsBreakdown(
+        incoterm=incoterm,
+        jurisdiction=jurisdiction,
+        jurisdiction_note=jurisdiction_note,
+        discount_pct=discount_pct,
+        discount=discount,
+        discount_note=discount_note,
+        freight_pct=freight_pct,
+        freight=freight,
+        taxable_amount=taxable_amount,
+        vat_pct=vat_pct,
+        vat=vat,
+        grand_total=grand_total
+    )
+
+# Prompt construction and token budgeting
+DEFAULT_MAX_TOKENS = 500
+COMPACT_MAX_TOKENS = 300
+MIN_COMPLETION_TOKENS = 150
+COMPACT_MAX_ITEMS = 10
+COMPACT_MAX_FIELD_CHARS = 80
+COMPACT_MAX_NOTES_CHARS = 300
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1500"))
+
+# Static prompt fragments per language, rendered once at import
+PROMPT_LANGUAGES = {"en": "English", "ar": "Arabic"}
+PROMPT_FRAGMENTS = {
+    lang: {
+        "header": f"Generate a professional quotation email in {language} language for the following:",
+        "closing": {
+            False: f"Please format as a professional business email in {language} with subject line, "
+                   "greeting, quotation details, and closing.",
+            True: f"Write a concise professional email in {language} with subject line, greeting, "
+                  "summary and closing.",
+        },
+    }
+    for lang, language in PROMPT_LANGUAGES.items()
+}
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the token count of a text locally (~4 ASCII chars or ~2 non-ASCII chars per token)."""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / 4 + other_chars / 2)
+
+@dataclass
+class EmailPrompt:
+    text: str
+    prompt_tokens: int
+    max_tokens: int
+    compact: bool
+    over_budget: bool = False
+
+def truncate(text: str, limit: int) -> str:
+    """Shorten text to at most `limit` characters, marking the cut with an ellipsis."""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+class PromptBuilder:
+    """Build email prompts from the precomputed per-language fragments within a token budget."""
+
+    def __init__(self, token_budget: int = PROMPT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+
+    @staticmethod
+    def format_line(item: "QuotationLine", currency: str, compact: bool = False) -> str:
+        sku = truncate(item.sku, COMPACT_MAX_FIELD_CHARS) if compact else item.sku
+        return f"{sku}: {item.qty} pcs × {currency} {item.unit_price:.2f} = {currency} {item.line_total:.2f}"
+
+    @staticmethod
+    def fragments(lang: str) -> dict:
+        """Return the prompt fragments for a language, falling back to English."""
+        fragments = PROMPT_FRAGMENTS.get(lang.lower())
+        if fragments is None:
+            logger.warning("Unsupported prompt language %r, falling back to English", lang)
+            fragments = PROMPT_FRAGMENTS["en"]
+        return fragments
+
+    def _render(self, request: "QuotationRequest", fragments: dict, lines: List[str], subtotal: float,
+                totals: TotalsBreakdown, compact: bool) -> str:
+        currency = request.currency
+        name, contact = request.client.name, request.client.contact
+        delivery_terms, notes = request.delivery_terms, request.notes or "None"
+        if compact:
+            # Cap free-text fields so a long note cannot blow the budget
+            name = truncate(name, COMPACT_MAX_FIELD_CHARS)
+            contact = truncate(contact, COMPACT_MAX_FIELD_CHARS)
+            delivery_terms = truncate(delivery_terms, COMPACT_MAX_FIELD_CHARS)
+            notes = truncate(notes, COMPACT_MAX_NOTES_CHARS)
+        return "\n".join([
+            fragments["header"],
+            "",
+            f"Client: {name} ({contact})",
+            f"Currency: {request.currency}",
+            f"Items: [{', '.join(lines)}]",
+            f"Subtotal: {currency} {subtotal:.2f}",
+            f"Discount ({totals.discount_pct:g}%): {currency} {totals.discount:.2f}"
+            + (f" ({totals.discount_note})" if totals.discount_note else ""),
+            f"Freight ({totals.freight_pct:g}%): {currency} {totals.freight:.2f}",
+            f"VAT ({totals.vat_pct:g}%): {currency} {totals.vat:.2f}"
+            + (f" ({totals.jurisdiction_note})" if totals.jurisdiction_note else ""),
+            f"Total: {currency} {totals.grand_total:.2f}",
+            f"Delivery Terms: {delivery_terms}",
+            f"Notes: {notes}",
+            "",
+            fragments["closing"][compact],
+        ])
+
+    def build(self, request: "QuotationRequest", items: List["QuotationLine"], subtotal: float,
+              totals: TotalsBreakdown) -> EmailPrompt:
+        """Build the full prompt, falling back to a compact one when it would exceed the budget."""
+        fragments = self.fragments(request.client.lang)
+        lines = [self.format_line(item, request.currency) for item in items]
+        text = self._render(request, fragments, lines, subtotal, totals, compact=False)
+        prompt_tokens = estimate_tokens(text)
+        if prompt_tokens + DEFAULT_MAX_TOKENS <= self.token_budget:
+            return EmailPrompt(text, prompt_tokens, DEFAULT_MAX_TOKENS, compact=False)
+
+        # Compact prompt: keep the largest lines, summarise the rest and cap free text
+        top = sorted(items, key=lambda item: item.line_total, reverse=True)[:COMPACT_MAX_ITEMS]
+        lines = [self.format_line(item, request.currency, compact=True) for item in top]
+        if len(items) > COMPACT_MAX_ITEMS:
+            lines.append(f"+{len(items) - COMPACT_MAX_ITEMS} more items")
+        text = self._render(request, fragments, lines, subtotal, totals, compact=True)
+        prompt_tokens = estimate_tokens(text)
+        max_tokens = min(COMPACT_MAX_TOKENS, self.token_budget - prompt_tokens)
+        if max_tokens >= MIN_COMPLETION_TOKENS:
+            return EmailPrompt(text, prompt_tokens, max_tokens, compact=True)
+
+        logger.warning(
+            "Compact prompt exceeds token budget: prompt_tokens=%d max_tokens=%d budget=%d",
+            prompt_tokens, MIN_COMPLETION_TOKENS, self.token_budget,
+        )
+        return EmailPrompt(text, prompt_tokens, MIN_COMPLETION_TOKENS, compact=True, over_budget=True)
+
+prompt_builder = PromptBuilder()
+
+def log_token_usage(quotation_id: str, prompt: EmailPrompt, response, email_draft: str,
+                    error: Optional[str] = None) -> None:
+    """Log prompt and completion token use, preferring the API usage report over local estimates."""
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or prompt.prompt_tokens
+    if error is not None:
+        # The call never completed, so there is no completion usage to record
+        logger.warning(
+            "quotation=%s prompt_tokens=%d completion_tokens=0 max_tokens=%d compact=%s error=%s",
+            quotation_id, prompt_tokens, prompt.max_tokens, prompt.compact, error,
+        )
+        return
+    completion_tokens = getattr(usage, "completion_tokens", None) or estimate_tokens(email_draft)
+    logger.info(
+        "quotation=%s prompt_tokens=%d completion_tokens=%d max_tokens=%d compact=%s over_budget=%s",
+        quotation_id, prompt_tokens, completion_tokens, prompt.max_tokens, prompt.compact, prompt.over_budget,
+    )
+
 def calculate_quotation(request: QuotationRequest) -> QuotationResponse:
     """Calculate quotation with pricing and generate email draft."""
     
@@ -211,33 +504,30 @@ def calculate_quotation(request: QuotationRequest) -> QuotationResponse:
             line_total=round(line_total, 2)
         ))
     
+    # Apply discount, freight and VAT
+    totals = calculate_totals(subtotal, request.delivery_terms, request.currency)
+    
     # Generate quotation ID
     import uuid
     quotation_id = str(uuid.uuid4())[:8].upper()
     
     # Generate email draft using OpenAI
-    email_prompt = f"""
-    Generate a professional quotation email in {request.client.lang} language for the following:
-    
-    Client: {request.client.name} ({request.client.contact})
-    Currency: {request.currency}
-    Items: {[f"{item.sku}: {item.qty} pcs × {request.currency} {item.unit_price:.2f} = {request.currency} {item.line_total:.2f}" for item in calculated_items]}
-    Total: {request.currency} {subtotal:.2f}
-    Delivery Terms: {request.delivery_terms}
-    Notes: {request.notes or 'None'}
-    
-    Please format as a professional business email with subject line, greeting, quotation details, and closing.
-    """
+    prompt = prompt_builder.build(request, calculated_items, subtotal, totals)
+    response = None
+    error = None
     
     try:
         response = client.chat(
             model="gpt-3.5-turbo" if os.getenv("OPENAI_API_KEY") else "mock",
-            messages=[{"role": "user", "content": email_prompt}],
-            max_tokens=500
+            messages=[{"role": "user", "content": prompt.text}],
+            max_tokens=prompt.max_tokens
         )
         email_draft = response.choices[0].message.content
     except Exception as e:
-        email_draft = f"Error generating email draft: {str(e)}"
+        error = str(e)
+        email_draft = f"Error generating email draft: {error}"
+    
+    log_token_usage(quotation_id, prompt, response, email_draft, error)
     
     return QuotationResponse(
         quotation_id=quotation_id,
@@ -247,7 +537,8 @@ def calculate_quotation(request: QuotationRequest) -> QuotationResponse:
         delivery_terms=request.delivery_terms,
         notes=request.notes,
         subtotal=round(subtotal, 2),
-        grand_total=round(subtotal, 2),  # No additional taxes/fees in this example
+        totals=totals,
+        grand_total=totals.grand_total,
         email_draft=email_draft
     )
 
@@ -1,6 +1,12 @@
+import logging
 import pytest
+import main
 from fastapi.testclient import TestClient
-from main import app, calculate_quotation, QuotationRequest, ClientInfo, QuotationItem
+from main import (
+    app, calculate_quotation, QuotationRequest, ClientInfo, QuotationItem, QuotationLine,
+    PromptBuilder, estimate_tokens, DEFAULT_MAX_TOKENS, COMPACT_MAX_ITEMS,
+    calculate_totals, parse_delivery_terms
+)
 
 client = TestClient(app)
 
@@ -61,7 +67,11 @@ def test_create_quotation_success():
     # ALR-OBL-12V: 95.5 * (1 + 18/100) * 40 = 95.5 * 1.18 * 40 = 4,507.6
     assert data["items"][1]["line_total"] == 4507.6
     
-    assert data["grand_total"] == 39643.6
+    assert data["subtotal"] == 39643.6
+    # DAP Dammam: 3% freight, 15% Saudi VAT on (subtotal + freight)
+    assert data["totals"]["freight"] == 1189.31
+    assert data["totals"]["vat"] == 6124.94
+    assert data["grand_total"] == 46957.85
     assert "email_draft" in data
 
 def test_create_quotation_arabic():
@@ -91,6 +101,8 @@ def test_create_quotation_arabic():
     data = response.json()
     assert data["client"]["lang"] == "ar"
     assert data["items"][0]["line_total"] == 28800.0  # 240 * 1.2 * 100
+    assert "ضريبة القيمة المضافة" in data["email_draft"]
+    assert "VAT" not in data["email_draft"]
 
 def test_create_quotation_invalid_data():
     """Test quotation creation with invalid data."""
@@ -131,6 +143,18 @@ def test_create_quotation_invalid_items():
     response = client.post("/quote", json=request_data)
     assert response.status_code == 422  # Validation error
 
+def test_create_quotation_invalid_currency():
+    """Test quotation creation with a currency that is not an ISO 4217 code."""
+    request_data = {
+        "client": {"name": "Test Company", "contact": "test@company.com", "lang": "en"},
+        "currency": "SAR" * 100,
+        "items": [{"sku": "TEST-001", "qty": 1, "unit_cost": 100.0, "margin_pct": 15}],
+        "delivery_terms": "FOB Port"
+    }
+    
+    response = client.post("/quote", json=request_data)
+    assert response.status_code == 422  # Validation error
+
 def test_calculate_quotation_function():
     """Test the calculate_quotation function directly."""
     request = QuotationRequest(
@@ -159,10 +183,171 @@ def test_calculate_quotation_function():
     assert result.currency == "USD"
     assert len(result.items) == 1
     assert result.items[0].line_total == 1200.0  # 100 * 1.2 * 10
-    assert result.grand_total == 1200.0
+    # FOB, no location given: no freight, default Saudi VAT
+    assert result.totals.incoterm == "FOB"
+    assert result.totals.vat == 180.0
+    assert result.grand_total == 1380.0
+    assert result.totals.grand_total == result.grand_total
+    assert result.totals.jurisdiction_note is not None
     assert result.email_draft is not None
     assert len(result.email_draft) > 0
 
+def _prompt_request(item_count: int) -> QuotationRequest:
+    return QuotationRequest(
+        client=ClientInfo(name="Test Company", contact="test@company.com", lang="en"),
+        currency="SAR",
+        items=[QuotationItem(sku=f"SKU-{i:03d}", qty=1, unit_cost=100.0, margin_pct=10) for i in range(item_count)],
+        delivery_terms="DAP Dammam",
+        notes=None
+    )
+
+def _prompt_lines(request: QuotationRequest) -> list:
+    return [
+        QuotationLine(sku=item.sku, qty=item.qty, unit_cost=item.unit_cost, margin_pct=item.margin_pct,
+                      unit_price=110.0, line_total=110.0 + i)
+        for i, item in enumerate(request.items)
+    ]
+
+def test_estimate_tokens():
+    """Test local token estimation for ASCII and Arabic text."""
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("مرحبا") == 3
+
+def test_prompt_builder_full_prompt():
+    """Test that small quotes get the full prompt and default max_tokens."""
+    request = _prompt_request(2)
+    prompt = PromptBuilder().build(request, _prompt_lines(request), 221.0, calculate_totals(221.0, "EXW Riyadh"))
+    assert not prompt.compact
+    assert prompt.max_tokens == DEFAULT_MAX_TOKENS
+    assert "SKU-000: 1 pcs × SAR 110.00 = SAR 110.00, SKU-001" in prompt.text
+    assert "VAT (15%): SAR 33.15" in prompt.text
+    assert "Total: SAR 254.15" in prompt.text
+    assert prompt.prompt_tokens == estimate_tokens(prompt.text)
+
+def test_prompt_builder_compact_prompt():
+    """Test that large quotes get a compact prompt and a smaller max_tokens."""
+    request = _prompt_request(100)
+    prompt = PromptBuilder(token_budget=1000).build(
+        request, _prompt_lines(request), 11000.0, calculate_totals(11000.0, "DAP Dammam")
+    )
+    assert prompt.compact
+    assert prompt.max_tokens < DEFAULT_MAX_TOKENS
+    assert prompt.text.count(" pcs ") == COMPACT_MAX_ITEMS
+    assert "SKU-099" in prompt.text
+    assert f"+{100 - COMPACT_MAX_ITEMS} more items" in prompt.text
+
+def test_prompt_builder_long_notes_within_budget():
+    """Test that few items with very long notes still fit the token budget."""
+    request = _prompt_request(1)
+    request.notes = "Spec compliance details. " * 320
+    builder = PromptBuilder()
+    prompt = builder.build(request, _prompt_lines(request), 110.0, calculate_totals(110.0, "DAP Dammam"))
+    assert prompt.compact
+    assert not prompt.over_budget
+    assert prompt.prompt_tokens + prompt.max_tokens <= builder.token_budget
+    assert len(prompt.text) < 2000
+
+def test_prompt_builder_over_budget_warning(caplog):
+    """Test that a prompt which cannot fit the budget is flagged and logged."""
+    request = _prompt_request(1)
+    caplog.set_level(logging.WARNING, logger="quotation")
+    prompt = PromptBuilder(token_budget=200).build(
+        request, _prompt_lines(request), 110.0, calculate_totals(110.0, "DAP Dammam")
+    )
+    assert prompt.over_budget
+    assert "exceeds token budget" in caplog.text
+
+def test_prompt_builder_language_fragments():
+    """Test that the prompt uses the per-language fragments."""
+    request = _prompt_request(1)
+    request.client.lang = "ar"
+    prompt = PromptBuilder().build(request, _prompt_lines(request), 110.0, calculate_totals(110.0, "DAP Dammam"))
+    assert "quotation email in Arabic language" in prompt.text
+    assert "email in Arabic with subject line" in prompt.text
+
+def test_prompt_builder_unsupported_language(caplog):
+    """Test that an unsupported language falls back to English with a warning."""
+    request = _prompt_request(1)
+    request.client.lang = "fr"
+    caplog.set_level(logging.WARNING, logger="quotation")
+    prompt = PromptBuilder().build(request, _prompt_lines(request), 110.0, calculate_totals(110.0, "DAP Dammam"))
+    assert "quotation email in English language" in prompt.text
+    assert "Unsupported prompt language 'fr'" in caplog.text
+
+def test_quote_logs_token_usage(caplog):
+    """Test that prompt and completion token use is logged per request."""
+    caplog.set_level(logging.INFO, logger="quotation")
+    response = client.post("/quote", json={
+        "client": {"name": "Test Company", "contact": "test@company.com", "lang": "en"},
+        "currency": "SAR",
+        "items": [{"sku": "TEST-001", "qty": 10, "unit_cost": 100.0, "margin_pct": 20}],
+        "delivery_terms": "DAP Dammam"
+    })
+    assert response.status_code == 200
+    assert f"quotation={response.json()['quotation_id']}" in caplog.text
+    assert "prompt_tokens=" in caplog.text
+    assert "completion_tokens=" in caplog.text
+
+def test_quote_logs_failed_completion(caplog, monkeypatch):
+    """Test that a failed email call logs zero completion tokens and the error."""
+    class FailingClient:
+        def chat(self, **kwargs):
+            raise RuntimeError("upstream unavailable")
+
+    monkeypatch.setattr(main, "client", FailingClient())
+    caplog.set_level(logging.INFO, logger="quotation")
+    request = _prompt_request(1)
+    result = calculate_quotation(request)
+    assert result.email_draft.startswith("Error generating email draft")
+    assert "completion_tokens=0" in caplog.text
+    assert "error=upstream unavailable" in caplog.text
+
+def test_parse_delivery_terms():
+    """Test Incoterm and jurisdiction parsing from free-text delivery terms."""
+    assert parse_delivery_terms("DAP Dammam, 4 weeks") == ("DAP", "SA")
+    assert parse_delivery_terms("DAP الرياض، 3 أسابيع") == ("DAP", "SA")
+    assert parse_delivery_terms("exw Dubai") == ("EXW", "AE")
+    assert parse_delivery_terms("4 weeks") == (None, None)
+    assert parse_delivery_terms("DAP بالرياض") == ("DAP", "SA")
+    assert parse_delivery_terms("CIF بدبي") == ("CIF", "AE")
+    assert parse_delivery_terms("DAP Riyadh, transshipment via Dubai") == ("DAP", "SA")
+    # City names embedded in other words must not set the jurisdiction
+    assert parse_delivery_terms("FOB Dubaiyya") == ("FOB", None)
+    assert parse_delivery_terms("DAP Muscatine, Iowa") == ("DAP", None)
+
+def test_calculate_totals():
+    """Test discount, freight and VAT from the jurisdiction and delivery-term tables."""
+    totals = calculate_totals(300000.0, "DDP Abu Dhabi")
+    assert totals.discount_pct == 3.0
+    assert totals.discount == 9000.0
+    assert totals.freight == 10185.0  # 3.5% of 291,000
+    assert totals.taxable_amount == 301185.0
+    assert totals.vat_pct == 5.0
+    assert totals.vat == 15059.25
+    assert totals.grand_total == 316244.25
+    assert totals.jurisdiction_note is None
+
+    # Unknown destination: Saudi VAT applies, and the fallback is reported
+    totals = calculate_totals(1000.0, "DDP Cairo")
+    assert totals.incoterm == "DDP"
+    assert totals.jurisdiction == "SA"
+    assert totals.vat_pct == 15.0
+    assert "not recognised" in totals.jurisdiction_note
+
+    # Thresholds are in SAR: USD 30,000 (SAR 112,500) earns the 2% tier, USD 20,000 does not
+    assert calculate_totals(30000.0, "FOB", "USD").discount_pct == 2.0
+    assert calculate_totals(20000.0, "FOB", "USD").discount_pct == 0.0
+
+    totals = calculate_totals(120000.0, "FOB", "EUR")
+    assert totals.discount == 0.0
+    assert "unsupported currency EUR" in totals.discount_note
+
+    totals = calculate_totals(1000.0, "FOB Doha")
+    assert totals.discount == 0.0
+    assert totals.freight == 0.0
+    assert totals.vat == 0.0
+
 def test_openapi_docs():
     """Test that OpenAPI documentation is accessible."""
     response = client.get("/docs")